@@ -1,26 +1,391 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory
-from pymongo import MongoClient
+from flask import Flask, render_template as flask_render_template, request, redirect, url_for, session, flash, send_from_directory, jsonify, g, has_request_context
+from pymongo import MongoClient, UpdateOne, UpdateMany, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, ServerSelectionTimeoutError
+import bson
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.utils import secure_filename
 import os
 import base64
 import logging
-from datetime import datetime
+import logging.handlers
+import json
+import queue
+from datetime import datetime, timedelta, timezone
 import contextlib
+import atexit
 import uuid
+import threading
+import time
+import socket
+import click
+import re
+import random
+import math
+import functools
+from collections import OrderedDict
 
-logging.basicConfig(level=logging.INFO)
+PROCESS_STARTED = time.monotonic()
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+LOG_QUEUE_SIZE = 10000
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, using the field names Cloud Logging reads."""
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "trace", None):
+            entry["logging.googleapis.com/trace"] = record.trace
+        if getattr(record, "fields", None):
+            entry.update(record.fields)
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the current request's correlation id.
+
+    Attached to the queue handler so it runs on the request thread, before
+    the record is handed to the listener thread.
+    """
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            record.trace = g.get("trace")
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """Keep only LOG_SAMPLE_RATE of DEBUG records; other levels all pass."""
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < LOG_SAMPLE_RATE
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """Queue records for a listener thread so requests never wait on I/O.
+
+    The listener is started lazily in each process because threads do not
+    survive gunicorn's fork. Records are dropped when the queue is full.
+    """
+    def __init__(self, handler):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.handler = handler
+        self.dropped = 0
+        self._listener = None
+        self._listener_pid = None
+        self._start_lock = threading.Lock()
+    
+    def enqueue(self, record):
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def _start_listener(self):
+        with self._start_lock:
+            if self._listener_pid == os.getpid():
+                return
+            # Records queued by the parent belong to the parent's listener.
+            self.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self._listener = logging.handlers.QueueListener(self.queue, self.handler, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+    
+    def close(self):
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._listener_pid = None
+        super().close()
+
+def configure_logging():
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter())
+    
+    async_handler = AsyncLogHandler(stream_handler)
+    async_handler.addFilter(DebugSamplingFilter())
+    async_handler.addFilter(RequestContextFilter())
+    
+    root = logging.getLogger()
+    root.handlers[:] = [async_handler]
+    root.setLevel(LOG_LEVEL)
+    # Drain the queue before the interpreter exits.
+    atexit.register(async_handler.close)
+    return async_handler
+
+log_handler = configure_logging()
 logger = logging.getLogger(__name__)
 
-load_dotenv()
 app = Flask(__name__)
-app.secret_key = os.getenv('SECRET_KEY', 'saolsaol')
+app.jinja_options = dict(app.jinja_options, trim_blocks=True, lstrip_blocks=True)
 
 TEMP_UPLOAD_FOLDER = '/tmp'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
-os.makedirs(TEMP_UPLOAD_FOLDER, exist_ok=True)
+USER_CACHE_MAX_BYTES = int(os.getenv('USER_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+USER_VERSION_INDEX = [("_id", 1), ("version", 1)]
+
+COMMENT_PREVIEW_SIZE = 3
+COMMENTS_PAGE_SIZE = 20
+MAX_COMMENTS_PAGE_SIZE = 100
+GAME_SORTS = {
+    'rating': {'rating': -1},
+    'play_time': {'play_time': -1},
+    'name': {'name': 1},
+    'comments': {'comment_count': -1}
+}
+
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jinja_cache'))
+
+API_PREFIX = "/api/v1"
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+GAME_API_FIELDS = {"name", "genres", "photo", "play_time", "rating", "rating_enable", "optional_attributes"}
+GAME_API_DEFAULT_FIELDS = ["name", "genres", "play_time", "rating", "rating_enable", "optional_attributes"]
+USER_API_FIELDS = {"name", "gender", "avatar", "total_play_time", "most_played", "avarage_of_rating", "created_at"}
+USER_API_DEFAULT_FIELDS = ["name", "gender", "avatar", "total_play_time", "most_played", "avarage_of_rating", "created_at"]
+LIBRARY_API_FIELDS = {"game": "$game", "play_time": {"$ifNull": ["$play_time", 0]}, "rating": {"$ifNull": ["$rating", None]}, "comment": {"$ifNull": ["$text", ""]}}
+LIBRARY_API_DEFAULT_FIELDS = ["game", "play_time", "rating", "comment"]
+COMMENT_API_FIELDS = {"user": "$user", "text": {"$ifNull": ["$text", ""]}, "play_time": {"$ifNull": ["$play_time", 0]}}
+
+PLAY_TIME_BUFFER_ENABLED = os.getenv('PLAY_TIME_BUFFER', '0') == '1'
+PLAY_TIME_FLUSH_INTERVAL_MS = int(os.getenv('PLAY_TIME_FLUSH_INTERVAL_MS', 500))
+PLAY_TIME_FLUSH_MAX_EVENTS = int(os.getenv('PLAY_TIME_FLUSH_MAX_EVENTS', 200))
+PLAY_TIME_MAX_BUFFER_AGE_MS = int(os.getenv('PLAY_TIME_MAX_BUFFER_AGE_MS', 5000))
+
+COUNTER_SHARDS = int(os.getenv('COUNTER_SHARDS', 8))
+SHARD_WRITE_RATE_THRESHOLD = int(os.getenv('SHARD_WRITE_RATE_THRESHOLD', 50))
+SHARD_SUM_TTL_SECONDS = 2
+BENCH_DATABASE = "gamedb_bench"
+
+CACHE_INVALIDATION_ENABLED = os.getenv('CACHE_INVALIDATION', '1') == '1'
+CACHE_POLL_INTERVAL_SECONDS = 1
+CATALOG_CACHE_SIZE = 64
+CATALOG_CACHE_TTL_SECONDS = 10
+
+RECOMMENDATION_TOP_K = 5
+RECOMMENDATION_MIN_CO_PLAYERS = int(os.getenv('RECOMMENDATION_MIN_CO_PLAYERS', 1))
+RECOMMENDATION_MAX_GAMES_PER_USER = 50
+RECOMMENDATION_BATCH_SIZE = 500
+RECOMMENDATION_MAX_PENDING_PAIRS = 100000
+RECOMMENDATION_LEASE_SECONDS = 300
+RECOMMENDATION_APPLIED_BATCHES = 8
+
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memory')
+WRITE_RATE_PER_SECOND = float(os.getenv('WRITE_RATE_PER_SECOND', 2))
+WRITE_BURST = int(os.getenv('WRITE_BURST', 10))
+COALESCE_WINDOW_SECONDS = 2
+COALESCE_WAIT_SECONDS = 10
+
+STATS_BATCH_SIZE = 1000
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Filled by create_app() from the files under static/img/Man and static/img/Woman.
+AVATAR_MANIFEST = {"male": [], "female": []}
+DEFAULT_AVATARS = {"male": "/static/img/Man/image (11).png", "female": "/static/img/Woman/image (10).png"}
+
+_config_loaded = False
+_app_initialized = False
+
+def load_config():
+    global _config_loaded
+    if _config_loaded:
+        return
+    load_dotenv()
+    app.config["MONGO_URI"] = os.getenv("MONGO_URI")
+    app.secret_key = os.getenv('SECRET_KEY', 'saolsaol')
+    _config_loaded = True
+
+def create_app():
+    """Initialize the application once and return it.
+
+    Under gunicorn with preload_app this runs in the master process, so the
+    parsed config, compiled templates, avatar manifest and database indexes
+    are inherited by every forked worker instead of being rebuilt per worker.
+    """
+    global _app_initialized
+    if _app_initialized:
+        return app
+    
+    started = time.monotonic()
+    load_config()
+    os.makedirs(TEMP_UPLOAD_FOLDER, exist_ok=True)
+    AVATAR_MANIFEST.update(build_avatar_manifest())
+    app.jinja_env.bytecode_cache = make_bytecode_cache()
+    precompile_templates()
+    
+    with get_db_connection() as db:
+        if db is None:
+            logger.error("Database connection failed during startup. Indexes will be created on first use.")
+    
+    _app_initialized = True
+    set_gauge("create_app_seconds", time.monotonic() - started)
+    set_gauge("cold_start_seconds", time.monotonic() - PROCESS_STARTED)
+    logger.info(f"Application initialized in {time.monotonic() - started:.2f}s.")
+    return app
+
+def build_avatar_manifest():
+    manifest = {}
+    for gender, folder in (("male", "Man"), ("female", "Woman")):
+        directory = os.path.join(app.static_folder, "img", folder)
+        avatars = []
+        try:
+            for filename in os.listdir(directory):
+                name, extension = os.path.splitext(filename)
+                if name.startswith("image (") and name.endswith(")") and name[7:-1].isdigit():
+                    avatars.append((int(name[7:-1]), f"/static/img/{folder}/{filename}"))
+        except OSError as e:
+            logger.error(f"Could not read avatars from {directory}: {str(e)}")
+        manifest[gender] = [path for _, path in sorted(avatars)]
+    return manifest
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache that keeps working when its directory is read-only.
+
+    App Engine deploys the prebuilt .jinja_cache directory read-only, so
+    failing to write a bucket just means the template compiles in memory.
+    """
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+def make_bytecode_cache():
+    directory = TEMPLATE_CACHE_DIR
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            directory = os.path.join(TEMP_UPLOAD_FOLDER, 'jinja_cache')
+            os.makedirs(directory, exist_ok=True)
+    return TemplateBytecodeCache(directory)
+
+def precompile_templates():
+    compiled = 0
+    for template_name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(template_name)
+            compiled += 1
+        except Exception as e:
+            logger.error(f"Could not compile template {template_name}: {str(e)}")
+    return compiled
+
+@app.cli.command("build-templates")
+def build_templates_command():
+    """Prebuild the Jinja bytecode cache before deploying.
+
+    Run it with the same Python version as the deployed runtime, since the
+    cached bytecode is only reused by a matching interpreter.
+    """
+    app.jinja_env.bytecode_cache = make_bytecode_cache()
+    compiled = precompile_templates()
+    logger.info(f"Compiled {compiled} templates into {TEMPLATE_CACHE_DIR}.")
+
+_html_whitespace = re.compile(r'[ \t]*\n\s*')
+
+def render_template(template_name, **context):
+    """Render a template with indentation and blank lines collapsed.
+
+    Runs of whitespace containing a newline become a single newline, which
+    keeps inline scripts and inline element spacing intact. Render time is
+    recorded per template in /metrics.
+    """
+    started = time.monotonic()
+    html = _html_whitespace.sub('\n', flask_render_template(template_name, **context))
+    observe(f"render.{template_name}", time.monotonic() - started)
+    return html
+
+@app.context_processor
+def inject_avatar_manifest():
+    if not AVATAR_MANIFEST["male"] and not AVATAR_MANIFEST["female"]:
+        AVATAR_MANIFEST.update(build_avatar_manifest())
+    return {"avatar_manifest": AVATAR_MANIFEST}
+
+# Per-process metrics. Histograms count observations per latency bucket
+# (in milliseconds); gauges hold the last value set.
+_metrics = {"gauges": {}, "histograms": {}}
+_metrics_lock = threading.Lock()
+
+def set_gauge(name, value):
+    with _metrics_lock:
+        _metrics["gauges"][name] = value
+
+def increment_gauge(name, amount=1):
+    with _metrics_lock:
+        _metrics["gauges"][name] = _metrics["gauges"].get(name, 0) + amount
+
+def observe(name, seconds):
+    milliseconds = seconds * 1000
+    with _metrics_lock:
+        histogram = _metrics["histograms"].get(name)
+        if histogram is None:
+            histogram = {"count": 0, "sum_ms": 0.0, "buckets": {str(bound): 0 for bound in LATENCY_BUCKETS_MS}}
+            histogram["buckets"]["+Inf"] = 0
+            _metrics["histograms"][name] = histogram
+        
+        histogram["count"] += 1
+        histogram["sum_ms"] += milliseconds
+        for bound in LATENCY_BUCKETS_MS:
+            if milliseconds <= bound:
+                histogram["buckets"][str(bound)] += 1
+                break
+        else:
+            histogram["buckets"]["+Inf"] += 1
+
+_first_request_pid = None
+
+@app.before_request
+def start_request_timer():
+    load_config()
+    ensure_invalidation_listener()
+    g.request_started = time.monotonic()
+    
+    trace_header = request.headers.get("X-Cloud-Trace-Context", "")
+    trace_id = trace_header.split("/")[0]
+    g.request_id = request.headers.get("X-Request-ID") or trace_id or uuid.uuid4().hex
+    if trace_id and os.getenv("GOOGLE_CLOUD_PROJECT"):
+        g.trace = f"projects/{os.getenv('GOOGLE_CLOUD_PROJECT')}/traces/{trace_id}"
+
+@app.after_request
+def record_request_timing(response):
+    global _first_request_pid
+    started = g.get("request_started")
+    if started is not None and _first_request_pid != os.getpid():
+        _first_request_pid = os.getpid()
+        set_gauge("first_request_seconds", time.monotonic() - started)
+        set_gauge("process_start_to_first_response_seconds", time.monotonic() - PROCESS_STARTED)
+    
+    if g.get("request_id"):
+        response.headers["X-Request-ID"] = g.request_id
+    if started is not None:
+        logger.debug("Request completed", extra={"fields": {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round((time.monotonic() - started) * 1000, 2)
+        }})
+    return response
+
+@app.route('/metrics')
+def metrics():
+    with _metrics_lock:
+        snapshot = {
+            "pid": os.getpid(),
+            "gauges": dict(_metrics["gauges"], log_records_dropped=log_handler.dropped),
+            "histograms": {name: dict(histogram, buckets=dict(histogram["buckets"])) for name, histogram in _metrics["histograms"].items()}
+        }
+    return jsonify(snapshot)
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -56,23 +421,420 @@ def test_connection():
         logger.error(f"Test connection error: {str(e)}")
         return f"Connection problem: {str(e)}"
 
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return this process's shared MongoClient, connecting on first use.
+
+    MongoClient is not fork-safe, so a client inherited from the gunicorn
+    master is replaced by a new one in each worker.
+    """
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+    
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            load_config()
+            logger.debug("Attempting to connect to MongoDB...")
+            client = MongoClient(app.config["MONGO_URI"], serverSelectionTimeoutMS=5000)
+            client.admin.command('ping')
+            logger.info("MongoDB connection established successfully.")
+            _client = client
+            _client_pid = os.getpid()
+    return _client
+
+_lease_owner = None
+_lease_owner_pid = None
+
+def lease_owner():
+    """Return the id this process writes into the leases it holds.
+
+    It is derived after fork, so preloaded gunicorn workers do not share it.
+    """
+    global _lease_owner, _lease_owner_pid
+    if _lease_owner_pid != os.getpid():
+        _lease_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        _lease_owner_pid = os.getpid()
+    return _lease_owner
+
 @contextlib.contextmanager
 def get_db_connection():
-    client = None
-    try:
-        mongo_uri = os.getenv("MONGO_URI")
-        logger.info(f"Attempting to connect to MongoDB...")
-        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
-        client.admin.command('ping')
-        logger.info("MongoDB connection established successfully.")
-        yield client.gamedb
+    try:
+        db = get_client().gamedb
+        ensure_indexes(db)
     except Exception as e:
         logger.error(f"MongoDB connection error: {str(e)}")
-        yield None
+        db = None
+    yield db
+
+_indexes_ready = False
+
+def ensure_indexes(db):
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    try:
+        # Lets the user snapshot cache validate versions with a covered query.
+        db.users.create_index(USER_VERSION_INDEX, name="user_version")
+        db.game_counters.create_index("game_id")
+        db.users.create_index("name")
+        db.users.create_index("comments.game")
+        db.games.create_index("name")
+        _indexes_ready = True
+    except Exception as e:
+        logger.error(f"Index creation error: {str(e)}")
+
+# Per-process LRU of full user documents keyed by user id, bounded by their
+# BSON size. Every write to a user increments its "version" field, so an
+# entry is only served while the version read through the (_id, version)
+# index still matches. Documents written before versioning count as 0.
+_user_cache = OrderedDict()
+_user_cache_bytes = 0
+_user_cache_lock = threading.Lock()
+
+def get_cached_user(db, user_id):
+    """Return the user document for user_id, or None if it does not exist.
+
+    The returned document is shared between requests and must not be mutated.
+    """
+    user_id = str(user_id)
+    object_id = ObjectId(user_id)
+
+    stamp = next(
+        db.users.find({"_id": object_id}, {"_id": 1, "version": 1}).hint(USER_VERSION_INDEX).limit(1),
+        None
+    )
+    if stamp is None:
+        invalidate_cached_user(user_id)
+        return None
+
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached and cached[0] == (stamp.get("version") or 0):
+            _user_cache.move_to_end(user_id)
+            return cached[1]
+
+    user = db.users.find_one({"_id": object_id})
+    if user is None:
+        invalidate_cached_user(user_id)
+        return None
+
+    size = len(bson.encode(user))
+    if size > USER_CACHE_MAX_BYTES:
+        return user
+    
+    global _user_cache_bytes
+    with _user_cache_lock:
+        previous = _user_cache.pop(user_id, None)
+        if previous:
+            _user_cache_bytes -= previous[2]
+        _user_cache[user_id] = (user.get("version") or 0, user, size)
+        _user_cache_bytes += size
+        while _user_cache_bytes > USER_CACHE_MAX_BYTES:
+            _user_cache_bytes -= _user_cache.popitem(last=False)[1][2]
+    return user
+
+def invalidate_cached_user(user_id):
+    global _user_cache_bytes
+    with _user_cache_lock:
+        cached = _user_cache.pop(str(user_id), None)
+        if cached:
+            _user_cache_bytes -= cached[2]
+
+def clear_cached_users():
+    global _user_cache_bytes
+    with _user_cache_lock:
+        _user_cache.clear()
+        _user_cache_bytes = 0
+
+# Per-process LRU of catalog query results, keyed by (search, genre, sort).
+# It is only used while this worker's invalidation listener is running, and
+# entries also expire after CATALOG_CACHE_TTL_SECONDS since play_time
+# increments deliberately do not invalidate it.
+_catalog_cache = OrderedDict()
+_catalog_cache_lock = threading.Lock()
+_catalog_generation = 0
+
+def get_cached_catalog(key):
+    if _invalidation_mode is None:
+        return None
+    with _catalog_cache_lock:
+        cached = _catalog_cache.get(key)
+        if cached is None or cached[0] < time.monotonic():
+            return None
+        _catalog_cache.move_to_end(key)
+        return cached[1]
+
+def catalog_generation():
+    with _catalog_cache_lock:
+        return _catalog_generation
+
+def store_cached_catalog(key, value, generation):
+    """Cache a catalog result read while catalog_generation() was generation.
+
+    The result is dropped if an invalidation happened since, because it may
+    have been read before the change it missed.
+    """
+    if _invalidation_mode is None:
+        return
+    with _catalog_cache_lock:
+        if generation != _catalog_generation:
+            return
+        _catalog_cache[key] = (time.monotonic() + CATALOG_CACHE_TTL_SECONDS, value)
+        _catalog_cache.move_to_end(key)
+        while len(_catalog_cache) > CATALOG_CACHE_SIZE:
+            _catalog_cache.popitem(last=False)
+
+def clear_cached_catalog():
+    global _catalog_generation
+    with _catalog_cache_lock:
+        _catalog_generation += 1
+        _catalog_cache.clear()
+
+# Cross-worker cache invalidation. Each worker runs a listener thread that
+# follows a change stream on games and users and calls the local handlers for
+# every changed document. Where change streams are unavailable (standalone
+# servers, missing privileges) it polls cache_versions instead, which write
+# routes bump through notify_games_changed(). The user snapshot cache already
+# validates versions on read, so polling only needs to cover games.
+_invalidation_handlers = {"games": [], "users": []}
+_invalidation_mode = None
+_invalidation_listener_pid = None
+_invalidation_lock = threading.Lock()
+
+def on_invalidate(collection, handler):
+    """Register handler(document_id) for changes in collection.
+
+    document_id is None when the whole collection must be considered stale.
+    """
+    _invalidation_handlers[collection].append(handler)
+
+def publish_invalidation(collection, document_id=None):
+    for handler in _invalidation_handlers.get(collection, []):
+        try:
+            handler(document_id)
+        except Exception as e:
+            logger.error(f"Cache invalidation handler error: {str(e)}")
+
+def notify_games_changed(db, game_id=None):
+    publish_invalidation("games", game_id)
+    # cache_versions only feeds workers that poll. When this worker's change
+    # stream is open the deployment supports them, so other workers see the
+    # write itself and the extra round trip to one hot document is skipped.
+    if _invalidation_mode != "change_stream":
+        db.cache_versions.update_one({"_id": "games"}, {"$inc": {"version": 1}}, upsert=True)
+
+def _invalidate_user(user_id):
+    if user_id is None:
+        clear_cached_users()
+    else:
+        invalidate_cached_user(user_id)
+
+def _invalidate_game(game_id):
+    clear_cached_catalog()
+    with _counter_lock:
+        if game_id is None:
+            _shard_sums.clear()
+        else:
+            _shard_sums.pop(game_id, None)
+
+on_invalidate("users", _invalidate_user)
+on_invalidate("games", _invalidate_game)
+
+def _is_play_time_update(change):
+    if change.get("operationType") != "update":
+        return False
+    description = change.get("updateDescription", {})
+    return not description.get("removedFields") and set(description.get("updatedFields", {})) == {"play_time"}
+
+def _watch_changes(db):
+    global _invalidation_mode
+    pipeline = [{"$match": {"ns.coll": {"$in": ["games", "users"]}}}]
+    with db.watch(pipeline) as stream:
+        _invalidation_mode = "change_stream"
+        # Anything cached before the stream opened may have missed events.
+        for collection in _invalidation_handlers:
+            publish_invalidation(collection)
+        for change in stream:
+            if change["ns"]["coll"] == "games" and _is_play_time_update(change):
+                continue
+            publish_invalidation(change["ns"]["coll"], change.get("documentKey", {}).get("_id"))
+
+def _poll_cache_versions(db):
+    global _invalidation_mode
+    last_version = None
+    _invalidation_mode = "polling"
+    while True:
+        state = db.cache_versions.find_one({"_id": "games"}) or {}
+        if state.get("version") != last_version:
+            last_version = state.get("version")
+            publish_invalidation("games")
+        time.sleep(CACHE_POLL_INTERVAL_SECONDS)
+
+def _invalidation_loop():
+    global _invalidation_mode
+    use_change_stream = True
+    while True:
+        try:
+            with get_db_connection() as db:
+                if db is None:
+                    raise RuntimeError("Database connection failed")
+                if use_change_stream:
+                    _watch_changes(db)
+                else:
+                    _poll_cache_versions(db)
+        except OperationFailure as e:
+            if use_change_stream and _invalidation_mode != "change_stream":
+                logger.info(f"Change streams unavailable ({str(e)}). Polling cache_versions instead.")
+                use_change_stream = False
+                continue
+            logger.error(f"Cache invalidation error: {str(e)}")
+        except Exception as e:
+            logger.error(f"Cache invalidation error: {str(e)}")
+        
+        # Events may have been missed while disconnected.
+        _invalidation_mode = None
+        for collection in _invalidation_handlers:
+            publish_invalidation(collection)
+        time.sleep(CACHE_POLL_INTERVAL_SECONDS)
+
+def ensure_invalidation_listener():
+    # Threads do not survive fork, so each worker starts its own listener.
+    global _invalidation_listener_pid
+    if not CACHE_INVALIDATION_ENABLED or _invalidation_listener_pid == os.getpid():
+        return
+    with _invalidation_lock:
+        if _invalidation_listener_pid == os.getpid():
+            return
+        threading.Thread(target=_invalidation_loop, name="cache-invalidation", daemon=True).start()
+        _invalidation_listener_pid = os.getpid()
+
+# Per-user token buckets for the write routes. A bucket holds up to
+# WRITE_BURST tokens and refills at WRITE_RATE_PER_SECOND. The store is chosen
+# with RATE_LIMIT_STORE: "memory" keeps buckets in this process, "mongo"
+# shares them between workers and instances through the rate_limits
+# collection.
+class MemoryBucketStore:
+    max_buckets = 10000
+    
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+    
+    def take(self, key, rate, capacity):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            
+            if len(self._buckets) > self.max_buckets:
+                # Buckets that have refilled completely carry no state.
+                idle = capacity / rate
+                for stale_key in [k for k, (_, t) in self._buckets.items() if now - t >= idle]:
+                    del self._buckets[stale_key]
+        return allowed
+
+class MongoBucketStore:
+    def __init__(self):
+        self._indexed = False
+    
+    def take(self, key, rate, capacity):
+        with get_db_connection() as db:
+            if db is None:
+                # Fail open rather than locking every user out.
+                return True
+            
+            if not self._indexed:
+                db.rate_limits.create_index("updated", expireAfterSeconds=3600)
+                self._indexed = True
+            
+            elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated", "$$NOW"]}]}, 1000]}
+            refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}]}
+            update = [
+                {"$set": {"tokens": refilled, "updated": "$$NOW"}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ]
+            try:
+                bucket = db.rate_limits.find_one_and_update({"_id": key}, update, upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # A concurrent first request created the bucket; it exists now.
+                bucket = db.rate_limits.find_one_and_update({"_id": key}, update, upsert=True, return_document=ReturnDocument.AFTER)
+            return bucket["allowed"]
+
+rate_limit_store = MongoBucketStore() if RATE_LIMIT_STORE == 'mongo' else MemoryBucketStore()
+
+# Identical writes (same route, user and form) that arrive while one is in
+# flight get the first request's redirect instead of repeating the database
+# work. Idempotent writes, and plays carrying the submission_id rendered into
+# their form, also coalesce for COALESCE_WINDOW_SECONDS after it finished;
+# other repeats after completion are real and run again.
+_inflight_writes = {}
+_inflight_lock = threading.Lock()
+
+def _coalesce_write(key, handler, window):
+    now = time.monotonic()
+    with _inflight_lock:
+        for stale_key in [k for k, entry in _inflight_writes.items() if entry["expires"] and entry["expires"] < now]:
+            del _inflight_writes[stale_key]
+        
+        entry = _inflight_writes.get(key)
+        leader = entry is None
+        if leader:
+            entry = {"done": threading.Event(), "location": None, "expires": None}
+            _inflight_writes[key] = entry
+    
+    if not leader:
+        if entry["done"].wait(COALESCE_WAIT_SECONDS) and entry["location"]:
+            increment_gauge("coalesced_writes")
+            return redirect(entry["location"])
+        return handler()
+    
+    try:
+        response = handler()
+        entry["location"] = response.location if response.status_code in (301, 302, 303) else None
+        return response
     finally:
-        if client:
-            client.close()
-            logger.info("MongoDB connection closed.")
+        with _inflight_lock:
+            if window:
+                entry["expires"] = time.monotonic() + window
+            elif _inflight_writes.get(key) is entry:
+                del _inflight_writes[key]
+        entry["done"].set()
+
+def guard_write(action, idempotent=False):
+    """Rate limit a logged-in write route per user and coalesce duplicates."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get("user_id")
+            if not user_id:
+                return view(*args, **kwargs)
+            
+            def limited_view():
+                if not rate_limit_store.take(f"{action}:{user_id}", WRITE_RATE_PER_SECOND, WRITE_BURST):
+                    increment_gauge("rate_limited_writes")
+                    flash("You are doing that too often. Please wait a moment and try again.", "error")
+                    referrer = request.referrer
+                    if referrer and 'games' in referrer:
+                        return redirect(url_for("games"))
+                    return redirect(url_for("user_page"))
+                return view(*args, **kwargs)
+            
+            key = (action, user_id, tuple(sorted(request.form.items(multi=True))))
+            window = COALESCE_WINDOW_SECONDS if idempotent or request.form.get("submission_id") else 0
+            return _coalesce_write(key, limited_view, window)
+        return wrapper
+    return decorator
 
 @app.route('/')
 def index():
@@ -86,7 +848,7 @@ def home():
                 flash("Database connection failed. Please try again later.", "error")
                 return render_template("home.html", games=[], users=[])
             
-            games = list(db.games.find())
+            games = apply_sharded_counters(db, list(db.games.find()))
             users = list(db.users.find())
             
             return render_template("home.html", games=games, users=users)
@@ -125,43 +887,12 @@ def games():
                 flash("Database connection failed. Please try again later.", "error")
                 return render_template("games.html", games=[], all_genres=[])
             
-            query = {}
-            
-            if search:
-                query['name'] = {'$regex': search, '$options': 'i'}  
-                
-            if genre_filter:
-                query['genres'] = genre_filter
-            
-            games_cursor = db.games.find(query)
-            
-            if sort_by == 'rating':
-                games = list(games_cursor.sort('rating', -1))  
-            elif sort_by == 'play_time':
-                games = list(games_cursor.sort('play_time', -1))
-            elif sort_by == 'name':
-                games = list(games_cursor.sort('name', 1)) 
-            elif sort_by == 'comments':
-                games = list(games_cursor)
-                games.sort(key=lambda x: len(x.get('all_comments', [])) if x.get('all_comments') else 0, reverse=True)
-            else:
-                games = list(games_cursor)
-            
-            for game in games:
-                if "all_comments" in game and isinstance(game["all_comments"], list):
-                    game["all_comments"] = sorted(
-                        game["all_comments"],
-                        key=lambda comment: comment.get("play_time", 0),
-                        reverse=True
-                    )
-            
-            all_genres = set()
-            for game in db.games.find({}, {'genres': 1}):
-                for genre in game.get('genres', []):
-                    all_genres.add(genre)
+            games, all_genres = load_catalog(db, search, genre_filter, sort_by)
+            # Cached catalog entries are shared, so annotate copies.
+            games = [dict(game) for game in games]
             
             if 'user_id' in session:
-                user = db.users.find_one({"_id": ObjectId(session["user_id"])})
+                user = get_cached_user(db, session["user_id"])
                 if user:
                     for game in games:
                         user_comments = [comment for comment in user.get('comments', []) if comment.get('game') == game['name']]
@@ -174,12 +905,105 @@ def games():
                             game['user_rating'] = None
                             game['user_comment'] = ''
         
-        return render_template('games.html', games=games, all_genres=sorted(all_genres))
+        return render_template('games.html', games=games, all_genres=all_genres)
     except Exception as e:
         logger.error(f"Error in games route: {str(e)}")
         flash(f"An error occurred: {str(e)}", "error")
         return render_template("games.html", games=[], all_genres=[])
 
+def load_catalog(db, search, genre_filter, sort_by):
+    key = (search, genre_filter, sort_by)
+    cached = get_cached_catalog(key)
+    if cached is not None:
+        return cached
+    
+    generation = catalog_generation()
+    query = {}
+    
+    if search:
+        query['name'] = {'$regex': search, '$options': 'i'}  
+        
+    if genre_filter:
+        query['genres'] = genre_filter
+    
+    # all_comments is kept sorted by play_time on write, so the catalog
+    # only needs the count and the first few entries of each array.
+    pipeline = [{'$match': query}]
+    if sort_by in GAME_SORTS and sort_by != 'comments':
+        pipeline.append({'$sort': GAME_SORTS[sort_by]})
+    pipeline.append({'$addFields': {
+        'comment_count': {'$size': {'$ifNull': ['$all_comments', []]}},
+        'all_comments': {'$slice': [{'$ifNull': ['$all_comments', []]}, COMMENT_PREVIEW_SIZE]}
+    }})
+    if sort_by == 'comments':
+        pipeline.append({'$sort': GAME_SORTS[sort_by]})
+    
+    games = apply_sharded_counters(db, list(db.games.aggregate(pipeline)))
+    if sort_by == 'play_time':
+        # Sharded games only have part of their play time in the document,
+        # so order again once the shard sums are included.
+        games.sort(key=lambda game: game.get('play_time', 0), reverse=True)
+    all_genres = sorted(db.games.distinct('genres'))
+    
+    store_cached_catalog(key, (games, all_genres), generation)
+    return games, all_genres
+
+def fetch_game_comments(db, game_id, page=1, per_page=COMMENTS_PAGE_SIZE):
+    """Return one page of a game's comments, highest play time first.
+
+    Returns None when the game does not exist.
+    """
+    try:
+        object_id = ObjectId(game_id)
+    except (InvalidId, TypeError):
+        return None
+    
+    skip = (page - 1) * per_page
+    result = next(db.games.aggregate([
+        {'$match': {'_id': object_id}},
+        {'$project': {
+            'total': {'$size': {'$ifNull': ['$all_comments', []]}},
+            'comments': {'$slice': [{'$ifNull': ['$all_comments', []]}, skip, per_page]}
+        }}
+    ]), None)
+    if result is None:
+        return None
+    
+    return {
+        "game_id": str(object_id),
+        "page": page,
+        "per_page": per_page,
+        "total": result["total"],
+        "has_more": skip + len(result["comments"]) < result["total"],
+        "comments": [
+            {
+                "user": comment.get("user"),
+                "text": comment.get("text", ""),
+                "play_time": comment.get("play_time", 0)
+            }
+            for comment in result["comments"]
+        ]
+    }
+
+@app.route("/games/<game_id>/comments")
+def game_comments(game_id):
+    try:
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', COMMENTS_PAGE_SIZE, type=int), 1), MAX_COMMENTS_PAGE_SIZE)
+        
+        with get_db_connection() as db:
+            if db is None:
+                return jsonify({"error": "Database connection failed."}), 503
+            
+            result = fetch_game_comments(db, game_id, page, per_page)
+            if result is None:
+                return jsonify({"error": "Game not found."}), 404
+            
+            return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error in game_comments route: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/add_game", methods=["POST"])
 def add_game():
     if request.method == "POST":
@@ -223,6 +1047,7 @@ def add_game():
                     return redirect(url_for("home"))
                 
                 db.games.insert_one(game)
+                notify_games_changed(db, game["_id"])
             
             flash(f"Game '{name}' has been added successfully.", "success")
             return redirect(url_for("home"))
@@ -260,12 +1085,10 @@ def remove_game():
                                 
                                 db.users.update_one(
                                     {"_id": user_id},
-                                    {"$inc": {"total_play_time": -play_time}}
-                                )
-                                
-                                db.users.update_one(
-                                    {"_id": user_id},
-                                    {"$pull": {"comments": {"game": game["name"]}}}
+                                    {
+                                        "$inc": {"total_play_time": -play_time, "version": 1},
+                                        "$pull": {"comments": {"game": game["name"]}}
+                                    }
                                 )
                                 
                                 if user.get("most_played") == game["name"]:
@@ -286,6 +1109,12 @@ def remove_game():
                         logger.error(f"Error deleting game image: {str(e)}")
                 
                 db.games.delete_one({"_id": ObjectId(game_id)})
+                db.game_counters.delete_many({"game_id": ObjectId(game_id)})
+                db.games.update_many(
+                    {"similar_games.name": game["name"]},
+                    {"$pull": {"similar_games": {"name": game["name"]}}}
+                )
+                notify_games_changed(db, ObjectId(game_id))
                 
                 flash(f"Game '{game['name']}' has been successfully deleted.", "success")
             else:
@@ -329,6 +1158,8 @@ def toggle_rating():
                     {"$set": {"rating_enable": False}}
                 )
                 flash(f"Ratings and comments have been disabled for '{game['name']}'.", "success")
+            
+            notify_games_changed(db, game["_id"])
         
         return redirect(url_for("home"))
     except Exception as e:
@@ -361,7 +1192,8 @@ def add_user():
                 "most_played": None,
                 "avarage_of_rating": 0,
                 "comments": [],
-                "created_at": datetime.now()
+                "created_at": datetime.now(),
+                "version": 0
             }
             db.users.insert_one(user)
             flash(f"User '{name}' has been added successfully.", "success")
@@ -483,7 +1315,7 @@ def user_page():
                 flash("Database connection failed. Please try again later.", "error")
                 return redirect(url_for("home"))
                 
-            user = db.users.find_one({"_id": ObjectId(user_id)})
+            user = get_cached_user(db, user_id)
             
             if not user:
                 session.pop("user_id", None)
@@ -492,7 +1324,7 @@ def user_page():
                 flash("User account not found", "error")
                 return redirect(url_for("home"))
             
-            games = list(db.games.find())
+            games = apply_sharded_counters(db, list(db.games.find()))
             user_games = []
             
             for game in games:
@@ -511,14 +1343,26 @@ def user_page():
                     game_copy["user_comment"] = user_comment_text
                     
                     user_games.append(game_copy)
+            
+            # similar_games is precomputed by the recommendations job.
+            played = {game["name"] for game in user_games}
+            games_by_name = {game["name"]: game for game in games}
+            most_played = games_by_name.get(user.get("most_played"), {})
+            recommended_games = [
+                games_by_name[similar["name"]]
+                for similar in most_played.get("similar_games", [])
+                if similar["name"] in games_by_name and similar["name"] not in played
+            ]
         
-        return render_template("user_page.html", user=user, games=games, user_games=user_games)
+        return render_template("user_page.html", user=user, games=games, user_games=user_games,
+                               recommended_games=recommended_games, submission_id=uuid.uuid4().hex)
     except Exception as e:
         logger.error(f"Error in user_page: {str(e)}")
         flash(f"An error occurred: {str(e)}", "error")
         return redirect(url_for("home"))
 
 @app.route("/play_game", methods=["POST"])
+@guard_write("play_game")
 def play_game():
     try:
         if "user_id" not in session:
@@ -533,42 +1377,45 @@ def play_game():
                 flash("Database connection failed. Please try again later.", "error")
                 return redirect(url_for("home"))
                 
-            user = db.users.find_one({"_id": ObjectId(session["user_id"])})
-            game = db.games.find_one({"_id": ObjectId(game_id)})
+            user = get_cached_user(db, session["user_id"])
+            game = db.games.find_one({"_id": ObjectId(game_id)}, {"name": 1, "counter_shards": 1})
             
             if not user or not game:
                 flash("User or Game not found", "error")
                 return redirect(url_for("user_page"))
             
-            db.games.update_one(
-                {"_id": ObjectId(game_id)},
-                {"$inc": {"play_time": play_time}}
-            )
-            
-            db.users.update_one(
-                {"_id": ObjectId(session["user_id"])},
-                {"$inc": {"total_play_time": play_time}}
-            )
+            remember_counter_shards(game)
+            record_game_write(db, game["_id"])
             
             user_comment = None
             for comment in user.get("comments", []):
                 if comment.get("game") == game["name"]:
                     user_comment = comment
                     break
-                    
-            if user_comment:
-                db.users.update_one(
-                    {"_id": ObjectId(session["user_id"]), "comments.game": game["name"]},
-                    {"$inc": {"comments.$.play_time": play_time}}
-                )
+            
+            if user_comment and PLAY_TIME_BUFFER_ENABLED:
+                buffer_play_time(game["_id"], session["user_id"], game["name"], play_time)
             else:
-                new_comment = {"game": game["name"], "text": "", "play_time": play_time}
+                increment_game_play_time(db, game["_id"], play_time)
+                
                 db.users.update_one(
                     {"_id": ObjectId(session["user_id"])},
-                    {"$push": {"comments": new_comment}}
+                    {"$inc": {"total_play_time": play_time, "version": 1}}
                 )
-            
-            update_most_played_game(session["user_id"])
+                
+                if user_comment:
+                    db.users.update_one(
+                        {"_id": ObjectId(session["user_id"]), "comments.game": game["name"]},
+                        {"$inc": {"comments.$.play_time": play_time, "version": 1}}
+                    )
+                else:
+                    new_comment = {"game": game["name"], "text": "", "play_time": play_time}
+                    db.users.update_one(
+                        {"_id": ObjectId(session["user_id"])},
+                        {"$push": {"comments": new_comment}, "$inc": {"version": 1}}
+                    )
+                
+                update_most_played_game(session["user_id"])
             
             flash(f"You played {game['name']} for {play_time} hours", "success")
             
@@ -582,7 +1429,287 @@ def play_game():
         flash(f"An error occurred: {str(e)}", "error")
         return redirect(url_for("user_page"))
 
+# Write-behind buffer for play_game. When PLAY_TIME_BUFFER=1, repeat plays
+# only add to in-memory per-game, per-user and per-(user, game) totals, and a
+# background thread applies them with bulk_write every
+# PLAY_TIME_FLUSH_INTERVAL_MS or PLAY_TIME_FLUSH_MAX_EVENTS plays. A game's
+# first play for a user is still written directly since it creates the entry
+# in the user's comments. Unflushed deltas are lost if the process crashes,
+# so requests flush inline once the buffer is older than
+# PLAY_TIME_MAX_BUFFER_AGE_MS, bounding that loss even if the flusher stalls.
+_play_time_buffer = {"games": {}, "users": {}, "comments": {}, "events": 0, "oldest": None}
+_play_time_lock = threading.Lock()
+_play_time_wakeup = threading.Event()
+_play_time_flusher_pid = None
+
+def buffer_play_time(game_id, user_id, game_name, play_time):
+    now = time.monotonic()
+    with _play_time_lock:
+        games = _play_time_buffer["games"]
+        users = _play_time_buffer["users"]
+        comments = _play_time_buffer["comments"]
+        games[game_id] = games.get(game_id, 0) + play_time
+        users[user_id] = users.get(user_id, 0) + play_time
+        comments[(user_id, game_name)] = comments.get((user_id, game_name), 0) + play_time
+        _play_time_buffer["events"] += 1
+        if _play_time_buffer["oldest"] is None:
+            _play_time_buffer["oldest"] = now
+        
+        events = _play_time_buffer["events"]
+        age_ms = (now - _play_time_buffer["oldest"]) * 1000
+    
+    set_gauge("play_time_buffer_pending_events", events)
+    _ensure_play_time_flusher()
+    
+    if age_ms >= PLAY_TIME_MAX_BUFFER_AGE_MS:
+        flush_play_time_buffer()
+    elif events >= PLAY_TIME_FLUSH_MAX_EVENTS:
+        _play_time_wakeup.set()
+
+def flush_play_time_buffer():
+    with _play_time_lock:
+        if not _play_time_buffer["events"]:
+            return
+        pending = dict(_play_time_buffer)
+        _play_time_buffer.update({"games": {}, "users": {}, "comments": {}, "events": 0, "oldest": None})
+    
+    set_gauge("play_time_buffer_pending_events", 0)
+    started = time.monotonic()
+    
+    with get_db_connection() as db:
+        if db is None:
+            logger.error("Database connection failed in flush_play_time_buffer. Requeueing play time.")
+            _requeue_play_time(pending)
+            return
+        
+        game_ops = []
+        counter_ops = []
+        for game_id, delta in pending["games"].items():
+            collection, operation = game_play_time_op(game_id, delta)
+            (counter_ops if collection == "game_counters" else game_ops).append(operation)
+        user_ops = [
+            UpdateOne({"_id": ObjectId(user_id)}, {"$inc": {"total_play_time": delta, "version": 1}})
+            for user_id, delta in pending["users"].items()
+        ]
+        user_ops.extend(
+            UpdateOne(
+                {"_id": ObjectId(user_id), "comments.game": game_name},
+                {"$inc": {"comments.$.play_time": delta, "version": 1}}
+            )
+            for (user_id, game_name), delta in pending["comments"].items()
+        )
+        
+        # Users' comments are what check-stats treats as the source of truth,
+        # so they are written first. Game totals that fail afterwards are
+        # restored from them by the checker.
+        try:
+            db.users.bulk_write(user_ops, ordered=False)
+        except Exception as e:
+            if _nothing_written(e):
+                logger.error(f"Play time flush error, requeueing {pending['events']} plays: {str(e)}")
+                _requeue_play_time(pending)
+            else:
+                # Retrying a partly applied batch would double count.
+                logger.error(f"Play time flush error after a partial write, dropped {pending['events']} plays: {str(e)}")
+                increment_gauge("play_time_buffer_dropped_events", pending["events"])
+            return
+        
+        try:
+            if game_ops:
+                db.games.bulk_write(game_ops, ordered=False)
+            if counter_ops:
+                db.game_counters.bulk_write(counter_ops, ordered=False)
+        except Exception as e:
+            logger.error(f"Play time flush error, left the play time of {len(pending['games'])} games to check-stats: {str(e)}")
+            increment_gauge("play_time_buffer_dropped_game_deltas", len(pending["games"]))
+    
+    for user_id in pending["users"]:
+        update_most_played_game(user_id)
+    
+    observe("play_time_flush_lag", started - pending["oldest"])
+    observe("play_time_flush_duration", time.monotonic() - started)
+    set_gauge("play_time_last_flush_events", pending["events"])
+
+def _nothing_written(error):
+    if isinstance(error, ServerSelectionTimeoutError):
+        return True
+    if isinstance(error, BulkWriteError):
+        details = error.details
+        return not (details.get("nMatched") or details.get("nModified") or details.get("nUpserted"))
+    return False
+
+def _requeue_play_time(pending):
+    with _play_time_lock:
+        for key in ("games", "users", "comments"):
+            current = _play_time_buffer[key]
+            for item, delta in pending[key].items():
+                current[item] = current.get(item, 0) + delta
+        _play_time_buffer["events"] += pending["events"]
+        if _play_time_buffer["oldest"] is None or pending["oldest"] < _play_time_buffer["oldest"]:
+            _play_time_buffer["oldest"] = pending["oldest"]
+
+def _play_time_flush_loop():
+    while True:
+        _play_time_wakeup.wait(PLAY_TIME_FLUSH_INTERVAL_MS / 1000)
+        _play_time_wakeup.clear()
+        try:
+            flush_play_time_buffer()
+        except Exception as e:
+            logger.error(f"Play time flusher error: {str(e)}")
+
+def _ensure_play_time_flusher():
+    # Threads do not survive fork, so each worker starts its own flusher.
+    global _play_time_flusher_pid
+    if _play_time_flusher_pid == os.getpid():
+        return
+    with _play_time_lock:
+        if _play_time_flusher_pid == os.getpid():
+            return
+        threading.Thread(target=_play_time_flush_loop, name="play-time-flusher", daemon=True).start()
+        _play_time_flusher_pid = os.getpid()
+
+atexit.register(flush_play_time_buffer)
+
+# Sharded play_time counters for hot games. Once a game gets more than
+# SHARD_WRITE_RATE_THRESHOLD plays per second in one process it is marked with
+# counter_shards, and further increments go to a random one of that many
+# documents in game_counters instead of the game document. A game's play time
+# is then games.play_time plus the sum of its shards, so the remaining direct
+# $inc writes on games (such as remove_user) stay correct.
+_sharded_games = {}
+_game_write_rates = {}
+_shard_sums = {}
+_counter_lock = threading.Lock()
+
+def remember_counter_shards(game):
+    if game.get("counter_shards"):
+        _sharded_games[game["_id"]] = game["counter_shards"]
+
+def game_play_time_op(game_id, delta):
+    shards = _sharded_games.get(game_id)
+    if not shards:
+        return "games", UpdateOne({"_id": game_id}, {"$inc": {"play_time": delta}})
+    
+    shard = random.randrange(shards)
+    return "game_counters", UpdateOne(
+        {"_id": f"{game_id}:{shard}"},
+        {"$inc": {"play_time": delta}, "$setOnInsert": {"game_id": game_id, "shard": shard}},
+        upsert=True
+    )
+
+def increment_game_play_time(db, game_id, delta):
+    collection, operation = game_play_time_op(game_id, delta)
+    db[collection].bulk_write([operation])
+
+def record_game_write(db, game_id):
+    if game_id in _sharded_games:
+        return
+    
+    now = time.monotonic()
+    with _counter_lock:
+        window_start, count = _game_write_rates.get(game_id, (now, 0))
+        if now - window_start >= 1:
+            window_start, count = now, 0
+        count += 1
+        _game_write_rates[game_id] = (window_start, count)
+        
+        if count <= SHARD_WRITE_RATE_THRESHOLD:
+            return
+        _game_write_rates.pop(game_id, None)
+    
+    db.games.update_one(
+        {"_id": game_id, "counter_shards": {"$exists": False}},
+        {"$set": {"counter_shards": COUNTER_SHARDS}}
+    )
+    _sharded_games[game_id] = COUNTER_SHARDS
+    logger.info(f"Game {game_id} switched to {COUNTER_SHARDS} sharded play time counters.")
+
+def apply_sharded_counters(db, games, fresh=False):
+    """Add the summed shard counters to play_time of games that have them.
+
+    Sums are cached for SHARD_SUM_TTL_SECONDS unless fresh is set.
+    """
+    sharded = [game for game in games if game.get("counter_shards")]
+    if not sharded:
+        return games
+    
+    now = time.monotonic()
+    sums = {}
+    missing = []
+    with _counter_lock:
+        for game in sharded:
+            remember_counter_shards(game)
+            cached = None if fresh else _shard_sums.get(game["_id"])
+            if cached and cached[0] > now:
+                sums[game["_id"]] = cached[1]
+            else:
+                missing.append(game["_id"])
+    
+    if missing:
+        fetched = {game_id: 0 for game_id in missing}
+        for result in db.game_counters.aggregate([
+            {"$match": {"game_id": {"$in": missing}}},
+            {"$group": {"_id": "$game_id", "play_time": {"$sum": "$play_time"}}}
+        ]):
+            fetched[result["_id"]] = result["play_time"]
+        
+        with _counter_lock:
+            for game_id, total in fetched.items():
+                _shard_sums[game_id] = (now + SHARD_SUM_TTL_SECONDS, total)
+        sums.update(fetched)
+    
+    for game in sharded:
+        game["play_time"] = game.get("play_time", 0) + sums.get(game["_id"], 0)
+    return games
+
+@app.cli.command("bench-play-time")
+@click.option("--threads", default=16, show_default=True)
+@click.option("--plays", default=500, show_default=True, help="Plays per thread.")
+@click.option("--shards", default=COUNTER_SHARDS, show_default=True)
+def bench_play_time_command(threads, plays, shards):
+    """Compare concurrent play_time increments on one game vs sharded counters.
+
+    Runs against the scratch gamedb_bench database, which is dropped after.
+    """
+    try:
+        client = get_client()
+    except Exception as e:
+        click.echo(f"Database connection failed: {str(e)}")
+        return
+    
+    db = client[BENCH_DATABASE]
+    game_id = db.games.insert_one({"name": "bench", "play_time": 0}).inserted_id
+    try:
+        for label, game_shards in (("single document", 0), (f"{shards} shards", shards)):
+            if game_shards:
+                db.games.update_one({"_id": game_id}, {"$set": {"counter_shards": game_shards}})
+                _sharded_games[game_id] = game_shards
+            else:
+                _sharded_games.pop(game_id, None)
+            
+            def worker():
+                for _ in range(plays):
+                    increment_game_play_time(db, game_id, 1)
+            
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            started = time.monotonic()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.monotonic() - started
+            
+            click.echo(f"{label}: {threads * plays} plays in {elapsed:.2f}s ({threads * plays / elapsed:.0f} plays/s)")
+        
+        total = apply_sharded_counters(db, [db.games.find_one({"_id": game_id})], fresh=True)[0]["play_time"]
+        click.echo(f"Counted play time: {total} (expected {2 * threads * plays})")
+    finally:
+        _sharded_games.pop(game_id, None)
+        _shard_sums.pop(game_id, None)
+        client.drop_database(BENCH_DATABASE)
+
 @app.route("/rate_game", methods=["POST"])
+@guard_write("rate_game", idempotent=True)
 def rate_game():
     try:
         if "user_id" not in session:
@@ -597,7 +1724,7 @@ def rate_game():
                 flash("Database connection failed. Please try again later.", "error")
                 return redirect(url_for("home"))
                 
-            user = db.users.find_one({"_id": ObjectId(session["user_id"])})
+            user = get_cached_user(db, session["user_id"])
             game = db.games.find_one({"_id": ObjectId(game_id)})
             
             if not user or not game:
@@ -620,7 +1747,7 @@ def rate_game():
                 
             db.users.update_one(
                 {"_id": ObjectId(session["user_id"]), "comments.game": game["name"]},
-                {"$set": {"comments.$.rating": rating}}
+                {"$set": {"comments.$.rating": rating}, "$inc": {"version": 1}}
             )
             
             update_user_average_rating(session["user_id"])
@@ -639,6 +1766,7 @@ def rate_game():
         return redirect(url_for("games"))
 
 @app.route("/comment_game", methods=["POST"])
+@guard_write("comment_game", idempotent=True)
 def comment_game():
     try:
         if "user_id" not in session:
@@ -653,8 +1781,8 @@ def comment_game():
                 flash("Database connection failed. Please try again later.", "error")
                 return redirect(url_for("home"))
                 
-            user = db.users.find_one({"_id": ObjectId(session["user_id"])})
-            game = db.games.find_one({"_id": ObjectId(game_id)})
+            user = get_cached_user(db, session["user_id"])
+            game = db.games.find_one({"_id": ObjectId(game_id)}, {"all_comments": 0})
             
             if not user or not game:
                 flash("User or Game not found", "error")
@@ -676,31 +1804,29 @@ def comment_game():
                 
             db.users.update_one(
                 {"_id": ObjectId(session["user_id"]), "comments.game": game["name"]},
-                {"$set": {"comments.$.text": comment_text}}
+                {"$set": {"comments.$.text": comment_text}, "$inc": {"version": 1}}
             )
             
-            existing_comment = False
-            for comment in game.get("all_comments", []):
-                if comment.get("user") == user["name"]:
-                    existing_comment = True
-                    db.games.update_one(
-                        {"_id": ObjectId(game_id), "all_comments.user": user["name"]},
-                        {"$set": {
-                            "all_comments.$.text": comment_text,
-                            "all_comments.$.play_time": user_comment["play_time"]
-                        }}
-                    )
-                    break
-                    
-            if not existing_comment:
-                db.games.update_one(
-                    {"_id": ObjectId(game_id)},
-                    {"$push": {"all_comments": {
-                        "user": user["name"],
-                        "text": comment_text,
-                        "play_time": user_comment["play_time"]
-                    }}}
-                )
+            existing_comment = db.games.update_one(
+                {"_id": ObjectId(game_id), "all_comments.user": user["name"]},
+                {"$set": {
+                    "all_comments.$.text": comment_text,
+                    "all_comments.$.play_time": user_comment["play_time"]
+                }}
+            ).matched_count > 0
+            
+            # An empty $each with $sort re-sorts the array in place, keeping
+            # all_comments ordered by play_time for the paginated reads.
+            new_comments = [] if existing_comment else [{
+                "user": user["name"],
+                "text": comment_text,
+                "play_time": user_comment["play_time"]
+            }]
+            db.games.update_one(
+                {"_id": ObjectId(game_id)},
+                {"$push": {"all_comments": {"$each": new_comments, "$sort": {"play_time": -1}}}}
+            )
+            notify_games_changed(db, game["_id"])
                 
             flash(f"Your comment on {game['name']} has been saved.", "success")
             
@@ -729,7 +1855,7 @@ def update_most_played_game(user_id):
             if not user.get("comments") or len(user["comments"]) == 0:
                 db.users.update_one(
                     {"_id": ObjectId(user_id)},
-                    {"$set": {"most_played": None}}
+                    {"$set": {"most_played": None}, "$inc": {"version": 1}}
                 )
                 return
             
@@ -739,12 +1865,12 @@ def update_most_played_game(user_id):
             if most_commented_game.get("play_time", 0) == 0:
                 db.users.update_one(
                     {"_id": ObjectId(user_id)},
-                    {"$set": {"most_played": None}}
+                    {"$set": {"most_played": None}, "$inc": {"version": 1}}
                 )
             else:
                 db.users.update_one(
                     {"_id": ObjectId(user_id)},
-                    {"$set": {"most_played": most_played_game}}
+                    {"$set": {"most_played": most_played_game}, "$inc": {"version": 1}}
                 )
     except Exception as e:
         logger.error(f"Most played game update error: {str(e)}")
@@ -766,7 +1892,7 @@ def update_user_average_rating(user_id):
             if not rated_comments:
                 db.users.update_one(
                     {"_id": ObjectId(user_id)},
-                    {"$set": {"avarage_of_rating": 0}}
+                    {"$set": {"avarage_of_rating": 0}, "$inc": {"version": 1}}
                 )
                 return
             
@@ -774,7 +1900,7 @@ def update_user_average_rating(user_id):
             
             db.users.update_one(
                 {"_id": ObjectId(user_id)},
-                {"$set": {"avarage_of_rating": round(avg_rating, 1)}}
+                {"$set": {"avarage_of_rating": round(avg_rating, 1)}, "$inc": {"version": 1}}
             )
     except Exception as e:
         logger.error(f"User average rating update error: {str(e)}")
@@ -810,6 +1936,7 @@ def update_game_rating(game_id):
                     {"_id": ObjectId(game_id)},
                     {"$set": {"rating": 0}}
                 )
+                notify_games_changed(db, ObjectId(game_id))
                 return
             
             weighted_rating = total_weighted_rating / total_play_time
@@ -818,6 +1945,7 @@ def update_game_rating(game_id):
                 {"_id": ObjectId(game_id)},
                 {"$set": {"rating": round(weighted_rating, 1)}}
             )
+            notify_games_changed(db, ObjectId(game_id))
     except Exception as e:
         logger.error(f"Game rating update error: {str(e)}")
 
@@ -846,99 +1974,1030 @@ def debug_user():
                 "comments": comments
             }
             
-            return str(result)
+            return jsonify(to_json_document(result))
     except Exception as e:
         logger.error(f"Error in debug_user: {str(e)}")
         return f"Error: {str(e)}"
 
-def migrate_user_avatars():
+def to_json_document(value):
+    """Convert a MongoDB document into JSON-safe types, exposing _id as id."""
+    if isinstance(value, dict):
+        return {("id" if key == "_id" else key): to_json_document(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json_document(item) for item in value]
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def parse_fields(allowed, default):
+    """Turn the fields= query argument into a MongoDB projection.
+
+    Raises ValueError for fields that are not part of the public API.
+    """
+    requested = request.args.get('fields')
+    if not requested:
+        fields = default
+    else:
+        fields = [field.strip() for field in requested.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in allowed]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return {field: 1 for field in fields}
+
+def parse_limit():
+    return min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+
+def encode_cursor(play_time, name):
+    return base64.urlsafe_b64encode(json.dumps([play_time, name]).encode()).decode()
+
+def parse_play_time_cursor():
+    """Decode the cursor= query argument of an embedded list into
+    (play_time, name), or None on the first page.
+
+    Raises ValueError for cursors this API did not hand out.
+    """
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
     try:
-        logger.info("Checking for users without avatars or needing avatar updates...")
+        play_time, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(play_time, (int, float)) or not isinstance(name, str):
+        raise ValueError("Invalid cursor.")
+    return play_time, name
+
+def embedded_page(collection, document_id, array, key, fields, limit):
+    """Return one page of an embedded array ordered by play_time, then key,
+    and the cursor of the next page.
+
+    Paging is keyset based on the cursor= argument, so entries added or
+    removed meanwhile do not shift the following pages.
+    """
+    pipeline = [
+        {'$match': {'_id': document_id}},
+        {'$project': {array: 1}},
+        {'$unwind': f'${array}'},
+        {'$replaceRoot': {'newRoot': f'${array}'}}
+    ]
+    cursor = parse_play_time_cursor()
+    if cursor:
+        play_time, name = cursor
+        pipeline.append({'$match': {'$or': [
+            {'play_time': {'$lt': play_time}},
+            {'play_time': play_time, key: {'$gt': name}}
+        ]}})
+    pipeline += [
+        {'$sort': {'play_time': -1, key: 1}},
+        {'$limit': limit + 1},
+        {'$project': dict(fields, _id=0, _play_time='$play_time', _key=f'${key}')}
+    ]
+    
+    entries = list(collection.aggregate(pipeline))
+    next_cursor = None
+    if len(entries) > limit:
+        next_cursor = encode_cursor(entries[limit - 1]["_play_time"], entries[limit - 1]["_key"])
+    for entry in entries:
+        del entry["_play_time"], entry["_key"]
+    return entries[:limit], next_cursor
+
+def with_counter_shards(projection):
+    # Sharded games need counter_shards to report their full play_time.
+    if "play_time" in projection:
+        return dict(projection, counter_shards=1)
+    return projection
+
+def strip_counter_shards(games):
+    for game in games:
+        game.pop("counter_shards", None)
+    return games
+
+def api_response(payload, cache_control="public, no-cache"):
+    # no-cache lets clients and proxies store the body but revalidate it with
+    # If-None-Match, which is answered with an empty 304.
+    response = jsonify(payload)
+    response.headers["Cache-Control"] = cache_control
+    response.add_etag()
+    return response.make_conditional(request)
+
+def api_error(message, status):
+    return jsonify({"error": message}), status
+
+@app.route(f"{API_PREFIX}/games")
+def api_games():
+    try:
+        projection = parse_fields(GAME_API_FIELDS, GAME_API_DEFAULT_FIELDS)
+        limit = parse_limit()
+        
+        query = {}
+        if request.args.get('genre'):
+            query['genres'] = request.args['genre']
+        if request.args.get('cursor'):
+            query['_id'] = {'$gt': ObjectId(request.args['cursor'])}
         
         with get_db_connection() as db:
             if db is None:
-                logger.error("Database connection failed in migrate_user_avatars.")
-                return
+                return api_error("Database connection failed.", 503)
             
-            users_without_proper_avatar = list(db.users.find({
-                "$or": [
-                    {"avatar": {"$exists": False}},
-                    {"avatar": {"$in": ["/static/img/Man.png", "/static/img/Woman.png"]}}
-                ]
-            }))
+            games = list(db.games.find(query, with_counter_shards(projection)).sort('_id', 1).limit(limit + 1))
+            strip_counter_shards(apply_sharded_counters(db, games))
+        
+        next_cursor = str(games[limit - 1]["_id"]) if len(games) > limit else None
+        return api_response({
+            "data": to_json_document(games[:limit]),
+            "next_cursor": next_cursor
+        })
+    except (InvalidId, ValueError) as e:
+        return api_error(str(e), 400)
+    except Exception as e:
+        logger.error(f"Error in api_games: {str(e)}")
+        return api_error(str(e), 500)
+
+@app.route(f"{API_PREFIX}/games/<game_id>")
+def api_game(game_id):
+    try:
+        projection = parse_fields(GAME_API_FIELDS, GAME_API_DEFAULT_FIELDS)
+        
+        with get_db_connection() as db:
+            if db is None:
+                return api_error("Database connection failed.", 503)
             
-            if not users_without_proper_avatar:
-                logger.info("All users have up-to-date avatars. No migration needed.")
-                return
-                
-            logger.info(f"Found {len(users_without_proper_avatar)} users needing avatar updates. Migrating...")
+            game = db.games.find_one({"_id": ObjectId(game_id)}, with_counter_shards(projection))
+            if game:
+                strip_counter_shards(apply_sharded_counters(db, [game]))
+        
+        if not game:
+            return api_error("Game not found.", 404)
+        return api_response({"data": to_json_document(game)})
+    except (InvalidId, ValueError) as e:
+        return api_error(str(e), 400)
+    except Exception as e:
+        logger.error(f"Error in api_game: {str(e)}")
+        return api_error(str(e), 500)
+
+@app.route(f"{API_PREFIX}/games/<game_id>/comments")
+def api_game_comments(game_id):
+    try:
+        object_id = ObjectId(game_id)
+        limit = parse_limit()
+        
+        with get_db_connection() as db:
+            if db is None:
+                return api_error("Database connection failed.", 503)
             
-            for user in users_without_proper_avatar:
-                
-                if "gender" not in user:
-                    user["gender"] = "male"
-                
-                if user["gender"] == "female":
-                    avatar = "/static/img/Woman/image (10).png"
-                else:
-                    avatar = "/static/img/Man/image (11).png"
-                
-                if "avatar" in user and not user["avatar"].endswith(("Man.png", "Woman.png")):
-                    avatar = user["avatar"]
-                
-                db.users.update_one(
-                    {"_id": user["_id"]},
-                    {"$set": {
-                        "avatar": avatar,
-                        "gender": user["gender"]
-                    }}
-                )
-                logger.info(f"Updated user: {user.get('name', 'Unknown')} with avatar: {avatar}")
+            if db.games.find_one({"_id": object_id}, {"_id": 1}) is None:
+                return api_error("Game not found.", 404)
+            comments, next_cursor = embedded_page(db.games, object_id, "all_comments", "user", COMMENT_API_FIELDS, limit)
+        
+        return api_response({"data": to_json_document(comments), "next_cursor": next_cursor})
+    except (InvalidId, ValueError) as e:
+        return api_error(str(e), 400)
+    except Exception as e:
+        logger.error(f"Error in api_game_comments: {str(e)}")
+        return api_error(str(e), 500)
+
+@app.route(f"{API_PREFIX}/users/<user_id>")
+def api_user(user_id):
+    try:
+        projection = parse_fields(USER_API_FIELDS, USER_API_DEFAULT_FIELDS)
+        
+        with get_db_connection() as db:
+            if db is None:
+                return api_error("Database connection failed.", 503)
             
-            logger.info("Avatar migration completed successfully!")
+            user = db.users.find_one({"_id": ObjectId(user_id)}, projection)
+        
+        if not user:
+            return api_error("User not found.", 404)
+        return api_response({"data": to_json_document(user)})
+    except (InvalidId, ValueError) as e:
+        return api_error(str(e), 400)
     except Exception as e:
-        logger.error(f"Error during avatar migration: {str(e)}")
+        logger.error(f"Error in api_user: {str(e)}")
+        return api_error(str(e), 500)
 
-def migrate_user_created_at():
+@app.route(f"{API_PREFIX}/users/<user_id>/library")
+def api_user_library(user_id):
     try:
-        logger.info("Checking for users without created_at field...")
+        object_id = ObjectId(user_id)
+        fields = {field: LIBRARY_API_FIELDS[field] for field in parse_fields(LIBRARY_API_FIELDS, LIBRARY_API_DEFAULT_FIELDS)}
+        limit = parse_limit()
         
         with get_db_connection() as db:
             if db is None:
-                logger.error("Database connection failed in migrate_user_created_at.")
-                return
-                
-            users_without_date = list(db.users.find({"created_at": {"$exists": False}}))
+                return api_error("Database connection failed.", 503)
             
-            if not users_without_date:
-                logger.info("All users have created_at field. No migration needed.")
+            if db.users.find_one({"_id": object_id}, {"_id": 1}) is None:
+                return api_error("User not found.", 404)
+            library, next_cursor = embedded_page(db.users, object_id, "comments", "game", fields, limit)
+        
+        return api_response({"data": to_json_document(library), "next_cursor": next_cursor})
+    except (InvalidId, ValueError) as e:
+        return api_error(str(e), 400)
+    except Exception as e:
+        logger.error(f"Error in api_user_library: {str(e)}")
+        return api_error(str(e), 500)
+
+# Item-item recommendations ("players who played this also played").
+# Each user contributes a sparse vector of log(1 + play_time) per game. The
+# job keeps the last vector contributed by every user in user_vectors, pair
+# dot products in game_pairs and squared norms in game_norms, so a refresh
+# only applies the difference for users whose version changed, were added or
+# were removed, then rewrites similar_games on the games whose pairs moved.
+#
+# Differences are applied in batches that can be replayed. A batch first
+# stages the new vectors under user_vectors.pending, then increments pairs
+# and norms with updates that skip documents already stamped with the batch
+# id, and finally commits the staged vectors. A refresh that dies part way
+# leaves its batch staged and the next refresh finishes it first.
+def _user_play_vector(user):
+    comments = [comment for comment in user.get("comments", []) if comment.get("game") and comment.get("play_time", 0) > 0]
+    comments.sort(key=lambda comment: comment["play_time"], reverse=True)
+    return [[comment["game"], math.log1p(comment["play_time"])] for comment in comments[:RECOMMENDATION_MAX_GAMES_PER_USER]]
+
+def _add_vector(vector, sign, pair_deltas, norm_deltas):
+    for index, (game_a, weight_a) in enumerate(vector):
+        norm_deltas[game_a] = norm_deltas.get(game_a, 0) + sign * weight_a * weight_a
+        for game_b, weight_b in vector[index + 1:]:
+            key = (game_a, game_b) if game_a < game_b else (game_b, game_a)
+            delta = pair_deltas.setdefault(key, [0.0, 0])
+            delta[0] += sign * weight_a * weight_b
+            delta[1] += sign
+
+def _acquire_recommendation_lease(db):
+    now = datetime.now(timezone.utc)
+    try:
+        db.recommendation_state.update_one(
+            {
+                "_id": "refresh",
+                "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]
+            },
+            {"$set": {"lease_owner": lease_owner(), "lease_until": now + timedelta(seconds=RECOMMENDATION_LEASE_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another process is refreshing.
+        return False
+
+def _renew_recommendation_lease(db):
+    result = db.recommendation_state.update_one(
+        {"_id": "refresh", "lease_owner": lease_owner()},
+        {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=RECOMMENDATION_LEASE_SECONDS)}}
+    )
+    if result.matched_count == 0:
+        raise RuntimeError("Recommendation refresh lease was taken over by another process.")
+
+def _release_recommendation_lease(db):
+    db.recommendation_state.update_one(
+        {"_id": "refresh", "lease_owner": lease_owner()},
+        {"$unset": {"lease_owner": "", "lease_until": ""}}
+    )
+
+def _increment_once(collection, batch_id, increments):
+    """Apply {_id: {field: delta}} increments unless a document already has batch_id."""
+    operations = [
+        UpdateOne(
+            {"_id": document_id, "batches": {"$ne": batch_id}},
+            {
+                "$inc": inc,
+                "$push": {"batches": {"$each": [batch_id], "$slice": -RECOMMENDATION_APPLIED_BATCHES}}
+            },
+            upsert=True
+        )
+        for document_id, inc in increments
+    ]
+    if not operations:
+        return
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # A document already stamped misses the filter and its upsert then
+        # collides on _id, which is exactly the skip a replay needs.
+        if e.details.get("writeConcernErrors") or any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+def _flush_recommendation_deltas(db, batch_id, pair_deltas, norm_deltas, staged_ops, changed_games):
+    _renew_recommendation_lease(db)
+    if staged_ops:
+        db.user_vectors.bulk_write(staged_ops, ordered=False)
+    
+    _increment_once(db.game_pairs, batch_id, (
+        ({"a": a, "b": b}, {"dot": dot, "count": count}) for (a, b), (dot, count) in pair_deltas.items()
+    ))
+    _increment_once(db.game_norms, batch_id, (
+        (game, {"norm_sq": delta}) for game, delta in norm_deltas.items()
+    ))
+    
+    db.user_vectors.delete_many({"pending.batch": batch_id, "pending.version": None})
+    db.user_vectors.update_many(
+        {"pending.batch": batch_id},
+        [{"$set": {"version": "$pending.version", "vector": "$pending.vector"}}, {"$unset": "pending"}]
+    )
+    
+    changed_games.update(norm_deltas)
+    pair_deltas.clear()
+    norm_deltas.clear()
+    del staged_ops[:]
+
+def _replay_staged_batches(db, changed_games):
+    """Finish batches a previous refresh staged but did not commit."""
+    batch_ids = db.user_vectors.distinct("pending.batch")
+    for batch_id in batch_ids:
+        pair_deltas = {}
+        norm_deltas = {}
+        for doc in db.user_vectors.find({"pending.batch": batch_id}, {"vector": 1, "pending": 1}):
+            _add_vector(doc.get("vector", []), -1, pair_deltas, norm_deltas)
+            _add_vector(doc["pending"]["vector"], 1, pair_deltas, norm_deltas)
+        _flush_recommendation_deltas(db, batch_id, pair_deltas, norm_deltas, [], changed_games)
+    return len(batch_ids)
+
+def _stage_user_changes(db, batch, batch_id, pair_deltas, norm_deltas, staged_ops):
+    user_ids = [user_id for user_id, _ in batch]
+    users = {user["_id"]: user for user in db.users.find({"_id": {"$in": user_ids}}, {"comments": 1, "version": 1})}
+    previous = {doc["_id"]: doc for doc in db.user_vectors.find({"_id": {"$in": user_ids}}, {"vector": 1})}
+    
+    for user_id, _ in batch:
+        old = previous.get(user_id)
+        if old:
+            _add_vector(old.get("vector", []), -1, pair_deltas, norm_deltas)
+        
+        user = users.get(user_id)
+        if user is None:
+            version, vector = None, []
+        else:
+            version, vector = user.get("version") or 0, _user_play_vector(user)
+            _add_vector(vector, 1, pair_deltas, norm_deltas)
+        staged_ops.append(UpdateOne(
+            {"_id": user_id},
+            {"$set": {"pending": {"batch": batch_id, "version": version, "vector": vector}}},
+            upsert=True
+        ))
+
+def _changed_users(db):
+    """Yield (user_id, version) for users added, changed or removed since the
+    last refresh by merging both collections in _id order."""
+    users = db.users.find({}, {"_id": 1, "version": 1}).sort("_id", 1).hint(USER_VERSION_INDEX)
+    vectors = db.user_vectors.find({}, {"_id": 1, "version": 1}).sort("_id", 1)
+    user = next(users, None)
+    vector = next(vectors, None)
+    
+    while user is not None or vector is not None:
+        if vector is None or (user is not None and user["_id"] < vector["_id"]):
+            yield user["_id"], user.get("version") or 0
+            user = next(users, None)
+        elif user is None or vector["_id"] < user["_id"]:
+            yield vector["_id"], None
+            vector = next(vectors, None)
+        else:
+            if (user.get("version") or 0) != vector.get("version"):
+                yield user["_id"], user.get("version") or 0
+            user = next(users, None)
+            vector = next(vectors, None)
+
+def _store_similar_games(db, game_names):
+    existing = set(db.games.distinct("name"))
+    norms = {}
+    operations = []
+    
+    for game in game_names:
+        if game not in existing:
+            continue
+        
+        pairs = list(db.game_pairs.find({
+            "$or": [{"_id.a": game}, {"_id.b": game}],
+            "count": {"$gte": RECOMMENDATION_MIN_CO_PLAYERS},
+            "dot": {"$gt": 0}
+        }))
+        others = [pair["_id"]["b"] if pair["_id"]["a"] == game else pair["_id"]["a"] for pair in pairs]
+        missing = [name for name in others + [game] if name not in norms]
+        if missing:
+            norms.update((doc["_id"], doc["norm_sq"]) for doc in db.game_norms.find({"_id": {"$in": missing}}))
+        
+        scored = []
+        for pair, other in zip(pairs, others):
+            denominator = math.sqrt(max(norms.get(game, 0), 0) * max(norms.get(other, 0), 0))
+            if other in existing and denominator > 0:
+                scored.append({"name": other, "score": round(pair["dot"] / denominator, 4)})
+        scored.sort(key=lambda entry: entry["score"], reverse=True)
+        
+        operations.append(UpdateMany({"name": game}, {"$set": {"similar_games": scored[:RECOMMENDATION_TOP_K]}}))
+        if len(operations) >= RECOMMENDATION_BATCH_SIZE:
+            db.games.bulk_write(operations, ordered=False)
+            operations = []
+    
+    if operations:
+        db.games.bulk_write(operations, ordered=False)
+
+def refresh_recommendations(full=False):
+    """Apply changed users to the recommendation model and rewrite the
+    similar_games they affect, or rebuild everything when full is set.
+
+    Returns a summary dict, or None if the refresh failed.
+    """
+    try:
+        with get_db_connection() as db:
+            if db is None:
+                logger.error("Database connection failed in refresh_recommendations.")
                 return
+            
+            if not _acquire_recommendation_lease(db):
+                logger.info("Recommendations are being refreshed elsewhere. Skipping.")
+                return {"skipped": True}
+            
+            try:
+                return _refresh_recommendations(db, full)
+            finally:
+                _release_recommendation_lease(db)
+    except Exception as e:
+        logger.error(f"Error refreshing recommendations: {str(e)}")
+
+def _refresh_recommendations(db, full):
+    started = time.monotonic()
+    if full:
+        db.user_vectors.drop()
+        db.game_pairs.drop()
+        db.game_norms.drop()
+    db.game_pairs.create_index("_id.a")
+    db.game_pairs.create_index("_id.b")
+    db.user_vectors.create_index("pending.batch", sparse=True)
+    
+    pair_deltas = {}
+    norm_deltas = {}
+    staged_ops = []
+    changed_games = set()
+    batch = []
+    changed_users = 0
+    
+    replayed = _replay_staged_batches(db, changed_games)
+    if replayed:
+        logger.info(f"Replayed {replayed} interrupted recommendation batches.")
+    
+    batch_id = uuid.uuid4().hex
+    for change in _changed_users(db):
+        batch.append(change)
+        changed_users += 1
+        if len(batch) >= RECOMMENDATION_BATCH_SIZE:
+            _stage_user_changes(db, batch, batch_id, pair_deltas, norm_deltas, staged_ops)
+            batch = []
+            if len(pair_deltas) >= RECOMMENDATION_MAX_PENDING_PAIRS:
+                _flush_recommendation_deltas(db, batch_id, pair_deltas, norm_deltas, staged_ops, changed_games)
+                batch_id = uuid.uuid4().hex
+    
+    if batch:
+        _stage_user_changes(db, batch, batch_id, pair_deltas, norm_deltas, staged_ops)
+    _flush_recommendation_deltas(db, batch_id, pair_deltas, norm_deltas, staged_ops, changed_games)
+    db.game_pairs.delete_many({"count": {"$lte": 0}})
+    
+    if full:
+        changed_games = set(db.games.distinct("name"))
+    _store_similar_games(db, changed_games)
+    
+    if changed_games:
+        notify_games_changed(db)
+    logger.info(f"Recommendations refreshed for {len(changed_games)} games from {changed_users} changed users in {time.monotonic() - started:.1f}s.")
+    return {"changed_games": len(changed_games), "changed_users": changed_users}
+
+@app.cli.command("recommendations")
+@click.option("--full", is_flag=True, help="Rebuild from scratch instead of applying changed users.")
+def recommendations_command(full):
+    """Refresh the precomputed similar_games of every game."""
+    refresh_recommendations(full=full)
+
+# Consistency checker for the denormalized stats. Users' comments are the
+# source of truth: total_play_time, most_played and avarage_of_rating are
+# recomputed per user, and games.play_time and games.rating per game, with
+# aggregation pipelines whose cursors are streamed and repaired in batches.
+# games.all_comments entries must belong to an existing user who still has
+# that game and mirror that comment's text and play_time, and users'
+# comments must point at existing games.
+def _rated(path):
+    return {"$ne": [{"$type": path}, "missing"]}
+
+USER_STATS_PIPELINE = [
+    {"$project": {
+        "version": 1,
+        "total_play_time": 1,
+        "most_played": 1,
+        "avarage_of_rating": 1,
+        "expected_total": {"$sum": "$comments.play_time"},
+        "top": {"$reduce": {
+            "input": {"$ifNull": ["$comments", []]},
+            "initialValue": {"game": None, "play_time": 0},
+            "in": {"$cond": [
+                {"$gt": [{"$ifNull": ["$$this.play_time", 0]}, "$$value.play_time"]},
+                {"game": "$$this.game", "play_time": "$$this.play_time"},
+                "$$value"
+            ]}
+        }},
+        "ratings": {"$filter": {"input": {"$ifNull": ["$comments", []]}, "cond": _rated("$$this.rating")}}
+    }},
+    {"$project": {
+        "version": 1,
+        "total_play_time": 1,
+        "most_played": 1,
+        "avarage_of_rating": 1,
+        "expected_total": 1,
+        "expected_most_played": "$top.game",
+        "expected_rating": {"$cond": [
+            {"$gt": [{"$size": "$ratings"}, 0]},
+            {"$round": [{"$avg": "$ratings.rating"}, 1]},
+            0
+        ]}
+    }},
+    {"$match": {"$expr": {"$or": [
+        {"$ne": ["$total_play_time", "$expected_total"]},
+        {"$ne": [{"$ifNull": ["$most_played", None]}, "$expected_most_played"]},
+        {"$gt": [{"$abs": {"$subtract": [{"$ifNull": ["$avarage_of_rating", -1]}, "$expected_rating"]}}, 0.05]}
+    ]}}}
+]
+
+GAME_STATS_PIPELINE = [
+    {"$project": {"comments": 1}},
+    {"$unwind": "$comments"},
+    {"$group": {
+        "_id": "$comments.game",
+        "play_time": {"$sum": "$comments.play_time"},
+        "weighted_rating": {"$sum": {"$cond": [
+            _rated("$comments.rating"),
+            {"$multiply": ["$comments.play_time", "$comments.rating"]},
+            0
+        ]}},
+        "rated_play_time": {"$sum": {"$cond": [_rated("$comments.rating"), "$comments.play_time", 0]}}
+    }}
+]
+
+def _play_time_repairs(db, drifts, checked_at):
+    """Return play_time repairs for the (game, stored_play_time, drift) drifts
+    that the previous run saw as well.
+
+    The users are scanned before the games are read, so a play landing in
+    between shows up as drift once. Real drift is still there, unchanged, on
+    the next run. Each drift is recorded in stats_drift for that comparison.
+    """
+    if not drifts:
+        return []
+    previous = {doc["_id"]: doc["drift"] for doc in db.stats_drift.find({"_id": {"$in": [game["_id"] for game, _, _ in drifts]}})}
+    db.stats_drift.bulk_write([
+        UpdateOne({"_id": game["_id"]}, {"$set": {"drift": drift, "checked_at": checked_at}}, upsert=True)
+        for game, _, drift in drifts
+    ], ordered=False)
+    
+    # Matching the stored play_time skips games written since they were read.
+    return [
+        UpdateOne({"_id": game["_id"], "play_time": stored_play_time}, {"$inc": {"play_time": drift}})
+        for game, stored_play_time, drift in drifts
+        if previous.get(game["_id"]) == drift
+    ]
+
+def _expected_game_rating(expected):
+    if expected["rated_play_time"] > 0:
+        return round(expected["weighted_rating"] / expected["rated_play_time"], 1)
+    return 0
+
+def _rating_repair(db, game):
+    """Return the rating repair for game, or None if a fresh recount agrees.
+
+    The users scan finishes before any game is read, so a rating given
+    meanwhile would be overwritten with a stale value. The rating is
+    recounted from only this game's players, and the update applies only
+    while the rating that was read is unchanged.
+    """
+    name = game["name"]
+    fresh = next(db.users.aggregate(
+        [{"$match": {"comments.game": name}}] + GAME_STATS_PIPELINE[:2] + [{"$match": {"comments.game": name}}] + GAME_STATS_PIPELINE[2:]
+    ), None)
+    rating = _expected_game_rating(fresh) if fresh else 0
+    if abs(game.get("rating", 0) - rating) <= 0.05:
+        return None
+    return UpdateOne({"_id": game["_id"], "rating": game.get("rating")}, {"$set": {"rating": rating}})
+
+def _check_game_stats(db, report, repair):
+    checked_at = datetime.now(timezone.utc)
+    seen = set()
+    batch = []
+    
+    def check_batch(batch):
+        games = {game["name"]: game for game in db.games.find(
+            {"name": {"$in": [expected["_id"] for expected in batch]}},
+            {"name": 1, "play_time": 1, "rating": 1, "counter_shards": 1}
+        )}
+        stored = {game["_id"]: game.get("play_time") for game in games.values()}
+        apply_sharded_counters(db, list(games.values()), fresh=True)
+        game_ops = []
+        drifts = []
+        
+        for expected in batch:
+            game = games.get(expected["_id"])
+            if game is None:
+                report["orphan_user_comments"] += 1
+                if repair:
+                    db.users.update_many(
+                        {"comments.game": expected["_id"]},
+                        {"$pull": {"comments": {"game": expected["_id"]}}, "$inc": {"version": 1}}
+                    )
+                continue
+            
+            rating = _expected_game_rating(expected)
+            drift = expected["play_time"] - game.get("play_time", 0)
+            if drift:
+                report["game_play_time"] += 1
+                # $inc keeps sharded counters intact.
+                drifts.append((game, stored[game["_id"]], drift))
+            if abs(game.get("rating", 0) - rating) > 0.05:
+                report["game_rating"] += 1
+                operation = _rating_repair(db, game) if repair else None
+                if operation:
+                    game_ops.append(operation)
+        
+        if repair:
+            game_ops.extend(_play_time_repairs(db, drifts, checked_at))
+        if repair and game_ops:
+            db.games.bulk_write(game_ops, ordered=False)
+    
+    for expected in db.users.aggregate(GAME_STATS_PIPELINE, allowDiskUse=True, batchSize=STATS_BATCH_SIZE):
+        if expected["_id"] is None:
+            continue
+        seen.add(expected["_id"])
+        batch.append(expected)
+        if len(batch) >= STATS_BATCH_SIZE:
+            check_batch(batch)
+            batch = []
+    if batch:
+        check_batch(batch)
+    
+    # Games nobody has played must have zero play time and rating.
+    game_ops = []
+    drifts = []
+    for game in db.games.find({"$or": [{"play_time": {"$ne": 0}}, {"rating": {"$ne": 0}}, {"counter_shards": {"$exists": True}}]},
+                              {"name": 1, "play_time": 1, "rating": 1, "counter_shards": 1}):
+        if game["name"] in seen:
+            continue
+        stored_play_time = game.get("play_time")
+        apply_sharded_counters(db, [game], fresh=True)
+        if game.get("play_time", 0):
+            report["game_play_time"] += 1
+            if repair:
+                drifts.append((game, stored_play_time, -game["play_time"]))
+        if game.get("rating", 0):
+            report["game_rating"] += 1
+            operation = _rating_repair(db, game) if repair else None
+            if operation:
+                game_ops.append(operation)
+        if len(game_ops) + len(drifts) >= STATS_BATCH_SIZE:
+            game_ops.extend(_play_time_repairs(db, drifts, checked_at))
+            drifts = []
+            if game_ops:
+                db.games.bulk_write(game_ops, ordered=False)
+            game_ops = []
+    if repair:
+        game_ops.extend(_play_time_repairs(db, drifts, checked_at))
+    if repair and game_ops:
+        db.games.bulk_write(game_ops, ordered=False)
+    
+    if repair:
+        # Drift not seen again this run was a race, or has been repaired.
+        db.stats_drift.delete_many({"checked_at": {"$lt": checked_at}})
+
+def _check_user_stats(db, report, repair):
+    user_ops = []
+    for user in db.users.aggregate(USER_STATS_PIPELINE, allowDiskUse=True, batchSize=STATS_BATCH_SIZE):
+        if user.get("total_play_time") != user["expected_total"]:
+            report["user_total_play_time"] += 1
+        if user.get("most_played") != user["expected_most_played"]:
+            report["user_most_played"] += 1
+        if abs((user.get("avarage_of_rating") or 0) - user["expected_rating"]) > 0.05 or "avarage_of_rating" not in user:
+            report["user_average_rating"] += 1
+        if not repair:
+            continue
+        
+        # Matching on version skips users changed since the pipeline read them.
+        user_ops.append(UpdateOne(
+            {"_id": user["_id"], "version": user.get("version")},
+            {
+                "$set": {
+                    "total_play_time": user["expected_total"],
+                    "most_played": user["expected_most_played"],
+                    "avarage_of_rating": user["expected_rating"]
+                },
+                "$inc": {"version": 1}
+            }
+        ))
+        if len(user_ops) >= STATS_BATCH_SIZE:
+            db.users.bulk_write(user_ops, ordered=False)
+            user_ops = []
+    if user_ops:
+        db.users.bulk_write(user_ops, ordered=False)
+
+def _check_comment_mirrors(db, report, repair):
+    cursor = db.games.find(
+        {"all_comments.0": {"$exists": True}},
+        {"name": 1, "all_comments.user": 1, "all_comments.text": 1, "all_comments.play_time": 1}
+    )
+    games = []
+    
+    def check_batch(games):
+        names = {comment.get("user") for game in games for comment in game["all_comments"]}
+        users = {}
+        for user in db.users.find({"name": {"$in": list(names)}}, {"name": 1, "comments.game": 1, "comments.text": 1, "comments.play_time": 1}):
+            users[user["name"]] = {comment.get("game"): comment for comment in user.get("comments", [])}
+        
+        game_ops = []
+        resorted = []
+        for game in games:
+            for comment in game["all_comments"]:
+                user_games = users.get(comment.get("user"))
+                if user_games is None or game["name"] not in user_games:
+                    report["orphan_game_comments"] += 1
+                    game_ops.append(UpdateOne({"_id": game["_id"]}, {"$pull": {"all_comments": {"user": comment.get("user")}}}))
+                    continue
                 
-            logger.info(f"Found {len(users_without_date)} users without created_at. Migrating...")
+                user_comment = user_games[game["name"]]
+                fields = {}
+                if user_comment.get("text", "") != comment.get("text", ""):
+                    report["comment_text"] += 1
+                    fields["all_comments.$.text"] = user_comment.get("text", "")
+                if user_comment.get("play_time", 0) != comment.get("play_time", 0):
+                    report["comment_play_time"] += 1
+                    fields["all_comments.$.play_time"] = user_comment.get("play_time", 0)
+                    resorted.append(game["_id"])
+                if fields:
+                    # Matching the play_time read skips mirrors a play updated since.
+                    game_ops.append(UpdateOne(
+                        {"_id": game["_id"], "all_comments": {"$elemMatch": {"user": comment.get("user"), "play_time": comment.get("play_time")}}},
+                        {"$set": fields}
+                    ))
+        if repair and game_ops:
+            db.games.bulk_write(game_ops, ordered=False)
+        if repair and resorted:
+            # all_comments is kept ordered by play_time for the paginated reads.
+            db.games.update_many({"_id": {"$in": resorted}}, {"$push": {"all_comments": {"$each": [], "$sort": {"play_time": -1}}}})
+    
+    for game in cursor.batch_size(STATS_BATCH_SIZE):
+        games.append(game)
+        if len(games) >= STATS_BATCH_SIZE:
+            check_batch(games)
+            games = []
+    if games:
+        check_batch(games)
+
+def check_stats(repair=False):
+    """Report drift in the denormalized stats and optionally repair it.
+
+    Returns a dict of drift counts per field, or None if the database is
+    unreachable.
+    """
+    report = {
+        "orphan_user_comments": 0,
+        "orphan_game_comments": 0,
+        "comment_text": 0,
+        "comment_play_time": 0,
+        "game_play_time": 0,
+        "game_rating": 0,
+        "user_total_play_time": 0,
+        "user_most_played": 0,
+        "user_average_rating": 0
+    }
+    try:
+        with get_db_connection() as db:
+            if db is None:
+                logger.error("Database connection failed in check_stats.")
+                return None
             
-            for user in users_without_date:
-                db.users.update_one(
-                    {"_id": user["_id"]},
-                    {"$set": {"created_at": datetime.now()}}
-                )
-                logger.info(f"Updated user: {user.get('name', 'Unknown')} with current date")
+            started = time.monotonic()
+            # Orphaned user comments are removed before the user stats are
+            # recomputed from what remains.
+            _check_game_stats(db, report, repair)
+            _check_comment_mirrors(db, report, repair)
+            _check_user_stats(db, report, repair)
             
-            logger.info("Date migration completed successfully!")
+            if repair and any(report.values()):
+                notify_games_changed(db)
+            logger.info(f"Stats check {'repaired' if repair else 'found'} {sum(report.values())} drifted values in {time.monotonic() - started:.1f}s: {report}")
+            return report
     except Exception as e:
-        logger.error(f"Error during date migration: {str(e)}")
+        logger.error(f"Error during stats check: {str(e)}")
+        return None
 
-try:
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-        logger.info(f"Created upload directory: {UPLOAD_FOLDER}")
-except Exception as e:
-    logger.error(f"Could not create upload directory: {str(e)}")
+@app.cli.command("check-stats")
+@click.option("--repair", is_flag=True, help="Write the recomputed values back.")
+def check_stats_command(repair):
+    """Verify denormalized play time, rating and comment fields."""
+    report = check_stats(repair=repair)
+    if report is not None:
+        for field, count in report.items():
+            click.echo(f"{field}: {count}")
 
-if __name__ == "__main__":
+@app.route("/tasks/check-stats")
+def check_stats_task():
+    # App Engine strips X-Appengine-Cron from external requests, so only the
+    # cron service can trigger this.
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return "Forbidden", 403
+    report = check_stats(repair=True)
+    if report is None:
+        return "Stats check failed", 500
+    return jsonify(report)
+
+@app.route("/tasks/recommendations")
+def recommendations_task():
+    # Cron only, like /tasks/check-stats.
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return "Forbidden", 403
+    summary = refresh_recommendations()
+    if summary is None:
+        return "Recommendation refresh failed", 500
+    return jsonify(summary)
+
+def _avatar_migration_update(user):
+    gender = user.get("gender", "male")
+    
+    if gender == "female":
+        avatar = (AVATAR_MANIFEST["female"] or [DEFAULT_AVATARS["female"]])[0]
+    else:
+        avatar = (AVATAR_MANIFEST["male"] or [DEFAULT_AVATARS["male"]])[0]
+    
+    if user.get("avatar") and not user["avatar"].endswith(("Man.png", "Woman.png")):
+        avatar = user["avatar"]
+    
+    return {"$set": {"avatar": avatar, "gender": gender}, "$inc": {"version": 1}}
+
+def _created_at_migration_update(user):
+    return {"$set": {"created_at": datetime.now()}, "$inc": {"version": 1}}
+
+def _sort_comments_migration_update(game):
+    return {"$push": {"all_comments": {"$each": [], "$sort": {"play_time": -1}}}}
+
+def _user_version_migration_update(user):
+    return {"$set": {"version": 0}}
+
+# Applied in order; each id runs to completion once. Append new migrations
+# with the next number and never renumber existing ones.
+MIGRATIONS = [
+    {
+        "id": "0001_user_avatars",
+        "collection": "users",
+        "filter": {"$or": [
+            {"avatar": {"$exists": False}},
+            {"avatar": {"$in": ["/static/img/Man.png", "/static/img/Woman.png"]}}
+        ]},
+        "projection": {"avatar": 1, "gender": 1},
+        "update": _avatar_migration_update
+    },
+    {
+        "id": "0002_user_created_at",
+        "collection": "users",
+        "filter": {"created_at": {"$exists": False}},
+        "projection": {"_id": 1},
+        "update": _created_at_migration_update
+    },
+    {
+        "id": "0003_sort_game_comments",
+        "collection": "games",
+        "filter": {"all_comments.1": {"$exists": True}},
+        "projection": {"_id": 1},
+        "update": _sort_comments_migration_update
+    },
+    {
+        "id": "0004_user_version",
+        "collection": "users",
+        "filter": {"version": None},
+        "projection": {"_id": 1},
+        "update": _user_version_migration_update
+    }
+]
+
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 1000))
+MIGRATION_LEASE_SECONDS = 300
+
+def _acquire_migration_lease(db, migration_id):
+    now = datetime.now(timezone.utc)
+    try:
+        db.migrations.update_one(
+            {
+                "_id": migration_id,
+                "completed_at": {"$exists": False},
+                "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]
+            },
+            {
+                "$set": {"lease_owner": lease_owner(), "lease_until": now + timedelta(seconds=MIGRATION_LEASE_SECONDS)},
+                "$setOnInsert": {"started_at": now}
+            },
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another process holds the lease or the migration already finished.
+        return False
+
+def run_migration(db, migration, dry_run=False):
+    migration_id = migration["id"]
+    state = db.migrations.find_one({"_id": migration_id}) or {}
+    
+    if state.get("completed_at"):
+        return
+    
+    if not dry_run and not _acquire_migration_lease(db, migration_id):
+        logger.info(f"Migration {migration_id} is running elsewhere or already completed. Skipping.")
+        return
+    
+    query = dict(migration["filter"])
+    if state.get("last_id") is not None:
+        query["_id"] = {"$gt": state["last_id"]}
+        logger.info(f"Resuming migration {migration_id} after {state['last_id']}...")
+    
+    collection = db[migration["collection"]]
+    cursor = collection.find(query, migration["projection"]).sort("_id", 1).batch_size(MIGRATION_BATCH_SIZE)
+    
+    processed = state.get("processed", 0)
+    last_id = None
+    matched = 0
+    started = time.monotonic()
+    batch = []
+    
+    for document in cursor:
+        batch.append(UpdateOne({"_id": document["_id"]}, migration["update"](document)))
+        last_id = document["_id"]
+        matched += 1
+        
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            processed = _flush_migration_batch(db, migration_id, collection, batch, last_id, processed, dry_run)
+            batch = []
+    
+    if batch:
+        processed = _flush_migration_batch(db, migration_id, collection, batch, last_id, processed, dry_run)
+    
+    elapsed = time.monotonic() - started
+    rate = matched / elapsed if elapsed > 0 else 0
+    
+    if dry_run:
+        logger.info(f"[dry run] Migration {migration_id} would update {matched} documents ({elapsed:.1f}s scan).")
+        return
+    
+    result = db.migrations.update_one(
+        {"_id": migration_id, "lease_owner": lease_owner()},
+        {
+            "$set": {"completed_at": datetime.now(timezone.utc), "processed": processed},
+            "$unset": {"lease_owner": "", "lease_until": ""}
+        }
+    )
+    if result.matched_count == 0:
+        raise RuntimeError(f"Migration {migration_id} lease was taken over by another process.")
+    logger.info(f"Migration {migration_id} updated {matched} documents in {elapsed:.1f}s ({rate:.0f} docs/s).")
+
+def _flush_migration_batch(db, migration_id, collection, batch, last_id, processed, dry_run):
+    if dry_run:
+        return processed + len(batch)
+    
+    collection.bulk_write(batch, ordered=False)
+    processed += len(batch)
+    
+    # Checkpoint after every batch so an interrupted run resumes from here
+    # and renew the lease so no other process takes it over meanwhile.
+    result = db.migrations.update_one(
+        {"_id": migration_id, "lease_owner": lease_owner()},
+        {"$set": {
+            "last_id": last_id,
+            "processed": processed,
+            "lease_until": datetime.now(timezone.utc) + timedelta(seconds=MIGRATION_LEASE_SECONDS)
+        }}
+    )
+    if result.matched_count == 0:
+        # The lease expired and another process resumed from the last
+        # checkpoint, so stop before writing anything more.
+        raise RuntimeError(f"Migration {migration_id} lease was taken over by another process.")
+    logger.debug("Migration batch written", extra={"fields": {
+        "migration": migration_id, "batch_size": len(batch), "processed": processed, "last_id": last_id
+    }})
+    return processed
+
+def run_migrations(dry_run=False):
     try:
-        migrate_user_avatars()
-        migrate_user_created_at()
+        with get_db_connection() as db:
+            if db is None:
+                logger.error("Database connection failed in run_migrations.")
+                return
+            
+            for migration in MIGRATIONS:
+                run_migration(db, migration, dry_run)
     except Exception as e:
-        logger.error(f"Error during migration: {str(e)}")
+        logger.error(f"Error during migrations: {str(e)}")
+
+def start_background_migrations():
+    if os.getenv('RUN_MIGRATIONS_ON_STARTUP', '1') != '1':
+        return
+    threading.Thread(target=run_migrations, name="migrations", daemon=True).start()
+
+@app.cli.command("migrate")
+@click.option("--dry-run", is_flag=True, help="Report what would change without writing.")
+def migrate_command(dry_run):
+    """Apply pending data migrations."""
+    run_migrations(dry_run=dry_run)
+
+if __name__ == "__main__":
+    create_app()
+    run_migrations()
     
     app.run(host="0.0.0.0", port=8080, debug=True)
\ No newline at end of file
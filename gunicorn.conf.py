@@ -0,0 +1,16 @@
+import os
+
+bind = f":{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = 60
+
+# Import main.py (and run create_app) once in the master so workers fork
+# from an already initialized application.
+preload_app = True
+
+
+def worker_exit(server, worker):
+    # Write out any buffered play_game increments before the worker exits.
+    from app import flush_play_time_buffer
+    flush_play_time_buffer()
@@ -1,6 +1,9 @@
-from app import app
+from app import create_app, start_background_migrations
+
+app = create_app()
+start_background_migrations()
 
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port, debug=False)